@@ -1,42 +1,201 @@
 import os
-import tempfile
+import io
 import json
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import time
+import threading
+import queue
+import random
+import math
+import atexit
+import shutil
+import zipfile
+import gzip
+import hashlib
+import tempfile
+import multiprocessing
+from xml.sax.saxutils import escape as xml_escape
+import click
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from flask import Flask, render_template, request, jsonify, send_file, g, has_request_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+from text_extraction import UnsupportedFileError, W_NS, extract_text_from_file, extract_import_text
 import sqlite3
-import openai
-import pdfplumber
-import docx
 import logging
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
 import uuid
 import re
-import google.generativeai as genai
-from typing import Dict, List, Tuple, Optional, Any
+import string
+import textwrap
+import difflib
+from typing import Dict, List, Tuple, Optional, Any, IO, Callable, Iterable, Iterator
 
 app = Flask(__name__)
 CORS(app) 
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler("app.log"), logging.StreamHandler()]
-)
-logger = logging.getLogger(__name__)
-
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 
 app.config['DATABASE'] = 'cv_scanner.db'
 app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'docx', 'doc'}
+app.config['GEMINI_MODEL'] = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+app.config['PROMPT_TEMPLATE'] = os.getenv('PROMPT_TEMPLATE', 'cv_analysis')
+# Upper bound on estimated prompt tokens; inputs beyond it are trimmed
+app.config['PROMPT_TOKEN_BUDGET'] = int(os.getenv('PROMPT_TOKEN_BUDGET', 30000))
+app.config['REANALYSIS_PROMPT_TEMPLATE'] = 'cv_reanalysis'
+# A new CV version is reanalyzed incrementally only if at most this fraction of it changed
+app.config['REANALYSIS_MAX_CHANGED_RATIO'] = 0.5
+# Bulk import: extraction processes and rows inserted per transaction
+app.config['BULK_IMPORT_WORKERS'] = int(os.getenv('BULK_IMPORT_WORKERS', os.cpu_count() or 1))
+app.config['BULK_IMPORT_BATCH_SIZE'] = int(os.getenv('BULK_IMPORT_BATCH_SIZE', 100))
+# Request size limit for /api/bulk-upload-cv, which takes whole archives of CVs
+app.config['BULK_IMPORT_MAX_CONTENT_LENGTH'] = int(os.getenv('BULK_IMPORT_MAX_CONTENT_LENGTH', 1024 * 1024 * 1024))
+# Uploaded archives are imported by a background job; a running job whose progress has not
+# been recorded for this many seconds is reported as interrupted (e.g. its worker was restarted)
+app.config['BULK_IMPORT_STALE_AFTER'] = 10 * 60
+# Seconds a gunicorn worker may spend on one request before it is killed (passed as
+# --timeout in the Procfile); waits and leases below are sized to fit within it
+app.config['WORKER_TIMEOUT'] = int(os.getenv('WORKER_TIMEOUT', 120))
+# Number of proxies in front of the app whose X-Forwarded-For is trusted for the client IP
+app.config['PROXY_FIX_X_FOR'] = int(os.getenv('PROXY_FIX_X_FOR', 1))
+# Analysis coalescing (seconds): how long an Idempotency-Key replays its result, how long a
+# finished analysis is shared with identical requests, when an unfinished one is abandoned
+# (its worker has been killed by then), and how long a caller waits for one running elsewhere
+app.config['IDEMPOTENCY_KEY_TTL'] = 24 * 60 * 60
+app.config['ANALYSIS_COALESCE_WINDOW'] = 30
+app.config['ANALYSIS_CLAIM_TIMEOUT'] = app.config['WORKER_TIMEOUT']
+app.config['ANALYSIS_WAIT_TIMEOUT'] = app.config['WORKER_TIMEOUT'] // 4
+app.config['ANALYSIS_POLL_INTERVAL'] = 0.25
+# LLM scheduling: per-tier priority (lower runs first) and token bucket quota
+# (burst calls, refilled at per_minute), plus global capacity and timeouts in seconds.
+# Registered users are charged per account, anonymous callers per client IP.
+app.config['LLM_TIERS'] = {
+    'pro': {'priority': 0, 'burst': 50, 'per_minute': 30},
+    'free': {'priority': 1, 'burst': 10, 'per_minute': 5},
+    'anonymous': {'priority': 2, 'burst': 5, 'per_minute': 2},
+}
+app.config['LLM_DEFAULT_TIER'] = 'free'
+app.config['LLM_ANONYMOUS_TIER'] = 'anonymous'
+app.config['LLM_MAX_CONCURRENT'] = int(os.getenv('LLM_MAX_CONCURRENT', 4))
+# Queued calls give up early enough to leave most of the worker timeout for the call itself,
+# and a slot held by a killed worker is released once the worker timeout has passed
+app.config['LLM_QUEUE_TIMEOUT'] = app.config['WORKER_TIMEOUT'] // 4
+app.config['LLM_LEASE_SECONDS'] = app.config['WORKER_TIMEOUT']
+app.config['LLM_POLL_INTERVAL'] = 0.2
+# Number of rendered CV exports kept in memory per worker
+app.config['EXPORT_CACHE_SIZE'] = 256
+# Retention: analysis results older than RETENTION_DAYS are moved to gzipped JSON lines in
+# ARCHIVE_FOLDER, in batches with a pause between them so requests are never blocked for long.
+# Unreferenced uploads older than ORPHAN_UPLOAD_GRACE seconds are deleted. Runs every
+# RETENTION_INTERVAL seconds in one worker (0 disables the background scheduler).
+app.config['RETENTION_DAYS'] = int(os.getenv('RETENTION_DAYS', 365))
+app.config['ARCHIVE_FOLDER'] = 'archive'
+app.config['RETENTION_INTERVAL'] = int(os.getenv('RETENTION_INTERVAL', 6 * 60 * 60))
+app.config['RETENTION_BATCH_SIZE'] = 200
+app.config['RETENTION_BATCH_PAUSE'] = 0.05
+app.config['ORPHAN_UPLOAD_GRACE'] = 60 * 60
+app.config['VACUUM_PAGES_PER_STEP'] = 200
+# Logging: JSON records to stderr and, unless LOG_FILE is empty, appended to that file,
+# plus the fraction of high-volume records kept. All gunicorn workers append to the same
+# file, so it is rotated externally (e.g. logrotate) and reopened once it has been moved.
+app.config['LOG_FILE'] = os.getenv('LOG_FILE', 'app.log')
+app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+app.config['LOG_SAMPLE_RATE'] = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+
+if app.config['PROXY_FIX_X_FOR']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+# Configure logging
+class JsonLogFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("request_id", "method", "path", "status", "duration_ms", "timings"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        return json.dumps(entry, default=str)
+
+class RequestContextFilter(logging.Filter):
+    """
+    Attach the current request id to records, and keep only LOG_SAMPLE_RATE of
+    the records logged with extra={'sampled': True}.
+    Runs in the logging thread's caller, before the record is queued.
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'sampled', False) and random.random() >= app.config['LOG_SAMPLE_RATE']:
+            return False
+        if has_request_context() and 'request_id' in g:
+            record.request_id = g.request_id
+        return True
+
+# Rotating in-process is unsafe with several worker processes writing one file
+log_handlers = [logging.StreamHandler()]
+if app.config['LOG_FILE']:
+    log_handlers.append(WatchedFileHandler(app.config['LOG_FILE'], encoding='utf-8'))
+for handler in log_handlers:
+    handler.setFormatter(JsonLogFormatter())
+
+# Requests only put records on a queue; a background thread does the writing
+queue_handler = QueueHandler(queue.SimpleQueue())
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+queue_handler.addFilter(RequestContextFilter())
+logging.basicConfig(level=app.config['LOG_LEVEL'], handlers=[queue_handler])
+logger = logging.getLogger(__name__)
+
+def start_log_listener() -> None:
+    """Start the background log writer thread for this process."""
+    queue_handler.queue = queue.SimpleQueue()
+    listener = QueueListener(queue_handler.queue, *log_handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+start_log_listener()
+# Threads do not survive fork, so each gunicorn worker starts its own writer
+os.register_at_fork(after_in_child=start_log_listener)
+
+@contextmanager
+def log_stage(name: str) -> Iterator[None]:
+    """Time a stage of the current request; timings are logged when the request completes."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            g.setdefault('timings', {})[name] = round((time.perf_counter() - started) * 1000, 2)
+
+@app.before_request
+def start_request_log() -> None:
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def finish_request_log(response):
+    response.headers['X-Request-ID'] = g.request_id
+    logger.info("request completed", extra={
+        "sampled": response.status_code < 400,
+        "method": request.method,
+        "path": request.path,
+        "status": response.status_code,
+        "duration_ms": round((time.perf_counter() - g.request_started) * 1000, 2),
+        "timings": g.get('timings', {}),
+    })
+    return response
+
 
 # uploads folder
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # ai API key
 # openai.api_key = os.environ.get('OPENAI_API_KEY', 'your-api-key')
-genai.configure(api_key=os.getenv("GEMINI_API_KEY", "your-api-key"))
+# The Gemini client is imported and configured on first use, see get_gemini_model()
 
 # Database setup
 def init_db():
@@ -44,12 +203,16 @@ def init_db():
     with sqlite3.connect(app.config['DATABASE']) as conn:
         cursor = conn.cursor()
         
+        # Only takes effect on a new database; existing ones are converted by `flask run-retention --full-vacuum`
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        
         # Users table
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
+            tier TEXT DEFAULT 'free',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         ''')
@@ -62,10 +225,14 @@ def init_db():
             file_name TEXT NOT NULL,
             file_path TEXT NOT NULL,
             content TEXT,
+            previous_cv_id INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (previous_cv_id) REFERENCES cvs (id)
         )
         ''')
+        ensure_columns(cursor, 'cvs', {'previous_cv_id': 'INTEGER'})
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cvs_user_file_name ON cvs (user_id, file_name)')
         
         # Job descriptions table
         cursor.execute('''
@@ -90,16 +257,294 @@ def init_db():
             feedback TEXT,
             suggestions TEXT,
             improved_cv TEXT,
+            prompt_template TEXT,
+            prompt_version TEXT,
+            model TEXT,
+            base_result_id INTEGER,
+            status TEXT,
+            archived INTEGER NOT NULL DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id),
             FOREIGN KEY (cv_id) REFERENCES cvs (id),
-            FOREIGN KEY (job_description_id) REFERENCES job_descriptions (id)
+            FOREIGN KEY (job_description_id) REFERENCES job_descriptions (id),
+            FOREIGN KEY (base_result_id) REFERENCES analysis_results (id)
         )
         ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_results_cv_id ON analysis_results (cv_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_results_created_at ON analysis_results (created_at)')
+        
+        # Analysis requests table, used to coalesce duplicate /api/analyze calls
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_requests (
+            request_key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            result_id INTEGER,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (result_id) REFERENCES analysis_results (id)
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_requests_expires_at ON analysis_requests (expires_at)')
+        
+        # LLM quota buckets and scheduling queue, shared by all workers. Buckets were
+        # keyed by user_id before anonymous callers were charged per IP; they only hold
+        # transient rate-limit state, so an old table is simply recreated
+        cursor.execute('PRAGMA table_info(llm_quota_buckets)')
+        bucket_columns = {row[1] for row in cursor.fetchall()}
+        if bucket_columns and 'quota_key' not in bucket_columns:
+            cursor.execute('DROP TABLE llm_quota_buckets')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_quota_buckets (
+            quota_key TEXT PRIMARY KEY,
+            tier TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            last_served_at REAL DEFAULT 0,
+            calls_total INTEGER DEFAULT 0,
+            rejected_total INTEGER DEFAULT 0
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            quota_key TEXT,
+            priority INTEGER NOT NULL,
+            enqueued_at REAL NOT NULL,
+            started_at REAL,
+            lease_expires REAL NOT NULL
+        )
+        ''')
+        ensure_columns(cursor, 'llm_queue', {'quota_key': 'TEXT'})
+        
+        # Background bulk import jobs started by /api/bulk-upload-cv
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            status TEXT NOT NULL,
+            summary TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at REAL NOT NULL
+        )
+        ''')
+        
+        # Leases so that background maintenance runs in one worker at a time
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_leases (
+            name TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        )
+        ''')
+        
+        ensure_columns(cursor, 'users', {'tier': "TEXT DEFAULT 'free'"})
+        
+        # Databases created before results were tagged with their prompt and status
+        added = ensure_columns(cursor, 'analysis_results', {
+            'prompt_template': 'TEXT',
+            'prompt_version': 'TEXT',
+            'model': 'TEXT',
+            'base_result_id': 'INTEGER',
+            'status': 'TEXT',
+            'archived': 'INTEGER NOT NULL DEFAULT 0',
+        })
+        if 'status' in added:
+            # Older results only record a failed analysis in their feedback text
+            cursor.execute('''
+            UPDATE analysis_results
+            SET status = CASE WHEN feedback LIKE 'An error occurred during analysis%' THEN 'error' ELSE 'ok' END
+            ''')
+        
+        # Analytics rollups, kept in step with analysis_results by triggers
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_rollups (
+            scope TEXT NOT NULL,
+            scope_id TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            score_sum REAL NOT NULL DEFAULT 0,
+            score_sq_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, scope_id)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_rollup_buckets (
+            scope TEXT NOT NULL,
+            scope_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, scope_id, bucket)
+        )
+        ''')
+        replaced = create_rollup_triggers(cursor)
+        # Backfill existing results the first time, after an interrupted backfill, or when
+        # the triggers changed what they count
+        cursor.execute('''
+        SELECT (? OR NOT EXISTS (SELECT 1 FROM analysis_rollups)) AND EXISTS (SELECT 1 FROM analysis_results)
+        ''', (replaced,))
+        if cursor.fetchone()[0]:
+            rebuild_analysis_rollups(cursor)
         
         conn.commit()
 
-# Initialize database on startup
+def ensure_columns(cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]) -> List[str]:
+    """Add any missing columns to an existing table and return the names of those added."""
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in cursor.fetchall()}
+    added = []
+    for name, declaration in columns.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {declaration}')
+            added.append(name)
+    return added
+
+# Analytics rollups: each scope maps to the SQL expression of its id for a result row.
+# Ids are never NULL: older rows may have a NULL user_id, which is counted as anonymous user 0.
+ROLLUP_SCOPES = {
+    'all': "''",
+    'user': "COALESCE({row}.user_id, 0)",
+    'job': "COALESCE({row}.job_description_id, '')",
+    'day': "COALESCE(date({row}.created_at), '')",
+    'user_day': "COALESCE({row}.user_id, 0) || ':' || COALESCE(date({row}.created_at), '')",
+    'job_day': "COALESCE({row}.job_description_id, '') || ':' || COALESCE(date({row}.created_at), '')",
+}
+# Scores are counted in ten buckets: 0-9, 10-19, ..., 90-100
+ROLLUP_BUCKET = "MIN(MAX(CAST(COALESCE({row}.score, 0) / 10 AS INTEGER), 0), 9)"
+
+def rollup_trigger_statements(row: str, sign: str) -> str:
+    """Build the trigger statements that add (sign '+') or remove (sign '-') one result row from the rollups."""
+    score = f"COALESCE({row}.score, 0)"
+    bucket = ROLLUP_BUCKET.format(row=row)
+    statements = []
+    for scope, expression in ROLLUP_SCOPES.items():
+        scope_id = expression.format(row=row)
+        statements.append(f'''
+        INSERT OR IGNORE INTO analysis_rollups (scope, scope_id) VALUES ('{scope}', {scope_id});
+        UPDATE analysis_rollups
+        SET count = count {sign} 1,
+            score_sum = score_sum {sign} {score},
+            score_sq_sum = score_sq_sum {sign} {score} * {score}
+        WHERE scope = '{scope}' AND scope_id = {scope_id};
+        INSERT OR IGNORE INTO analysis_rollup_buckets (scope, scope_id, bucket) VALUES ('{scope}', {scope_id}, {bucket});
+        UPDATE analysis_rollup_buckets SET count = count {sign} 1
+        WHERE scope = '{scope}' AND scope_id = {scope_id} AND bucket = {bucket};''')
+    return "".join(statements)
+
+def create_rollup_triggers(cursor: sqlite3.Cursor) -> bool:
+    """
+    Create the triggers that keep analysis rollups in step with analysis_results.
+    Only successful analyses are counted. Rows deleted by retention are flagged as
+    archived first and stay counted, so the rollups keep the full history.
+    Triggers whose definition changed are replaced in one transaction, which is left
+    open for the caller to commit; returns whether any trigger was replaced.
+    """
+    update = 'UPDATE OF user_id, job_description_id, score, created_at, status'
+    triggers = {
+        'insert': ('INSERT', "WHEN NEW.status = 'ok'", rollup_trigger_statements('NEW', '+')),
+        'delete': ('DELETE', "WHEN OLD.archived = 0 AND OLD.status = 'ok'", rollup_trigger_statements('OLD', '-')),
+        # An update removes the old row and adds the new one, each only if it counts
+        'update_old': (update, "WHEN OLD.status = 'ok'", rollup_trigger_statements('OLD', '-')),
+        'update_new': (update, "WHEN NEW.status = 'ok'", rollup_trigger_statements('NEW', '+')),
+    }
+    wanted = {
+        f'analysis_rollups_{name}': f'''CREATE TRIGGER analysis_rollups_{name}
+        AFTER {event} ON analysis_results {condition}
+        BEGIN{statements}
+        END'''
+        for name, (event, condition, statements) in triggers.items()
+    }
+
+    # Workers importing the app at the same time must not drop each other's triggers
+    cursor.connection.commit()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'analysis_results'")
+    existing = {name: sql for name, sql in cursor.fetchall() if name.startswith('analysis_rollups_')}
+    if existing == wanted:
+        return False
+    for name in existing:
+        cursor.execute(f'DROP TRIGGER {name}')
+    for sql in wanted.values():
+        cursor.execute(sql)
+    return True
+
+def iter_archived_results() -> Iterator[Dict[str, Any]]:
+    """Yield the analysis result rows that retention moved to ARCHIVE_FOLDER."""
+    folder = app.config['ARCHIVE_FOLDER']
+    if not os.path.isdir(folder):
+        return
+    for name in sorted(os.listdir(folder)):
+        if not (name.startswith('analysis_results-') and name.endswith('.jsonl.gz')):
+            continue
+        try:
+            with gzip.open(os.path.join(folder, name), 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    yield json.loads(line)
+        except (EOFError, OSError, ValueError) as e:
+            # A batch cut short by a crash is still in analysis_results, since rows are deleted after writing
+            logger.warning(f"Archive {name} is truncated: {str(e)}")
+
+def rebuild_analysis_rollups(cursor: sqlite3.Cursor) -> None:
+    """Recompute all analysis rollups from the analysis_results rows and the retention archive."""
+    cursor.execute('''
+    CREATE TEMP TABLE IF NOT EXISTS archived_results (
+        id INTEGER PRIMARY KEY, user_id INTEGER, job_description_id INTEGER, score REAL, created_at TIMESTAMP,
+        status TEXT
+    )
+    ''')
+    cursor.execute('DELETE FROM temp.archived_results')
+    cursor.executemany('''
+    INSERT OR IGNORE INTO temp.archived_results (id, user_id, job_description_id, score, created_at, status)
+    VALUES (:id, :user_id, :job_description_id, :score, :created_at, :status)
+    ''', iter_archived_results())
+    source = '''(
+        SELECT user_id, job_description_id, score, created_at FROM analysis_results WHERE status = 'ok'
+        UNION ALL
+        SELECT user_id, job_description_id, score, created_at FROM temp.archived_results
+        WHERE status = 'ok' AND id NOT IN (SELECT id FROM analysis_results)
+    ) ar'''
+
+    cursor.execute('DELETE FROM analysis_rollups')
+    cursor.execute('DELETE FROM analysis_rollup_buckets')
+    bucket = ROLLUP_BUCKET.format(row='ar')
+    for scope, expression in ROLLUP_SCOPES.items():
+        scope_id = expression.format(row='ar')
+        cursor.execute(f'''
+        INSERT INTO analysis_rollups (scope, scope_id, count, score_sum, score_sq_sum)
+        SELECT '{scope}', {scope_id}, COUNT(*), SUM(COALESCE(ar.score, 0)), SUM(COALESCE(ar.score, 0) * COALESCE(ar.score, 0))
+        FROM {source}
+        GROUP BY {scope_id}
+        ''')
+        cursor.execute(f'''
+        INSERT INTO analysis_rollup_buckets (scope, scope_id, bucket, count)
+        SELECT '{scope}', {scope_id}, {bucket}, COUNT(*)
+        FROM {source}
+        GROUP BY {scope_id}, {bucket}
+        ''')
+    cursor.execute('DROP TABLE temp.archived_results')
+
+def read_rollup(cursor: sqlite3.Cursor, scope: str, scope_id: Any) -> Dict[str, Any]:
+    """Return count, average, standard deviation and score histogram for one rollup."""
+    cursor.execute('''
+    SELECT count, score_sum, score_sq_sum FROM analysis_rollups WHERE scope = ? AND scope_id = ?
+    ''', (scope, str(scope_id)))
+    row = cursor.fetchone()
+    count, score_sum, score_sq_sum = row if row else (0, 0, 0)
+
+    cursor.execute('''
+    SELECT bucket, count FROM analysis_rollup_buckets WHERE scope = ? AND scope_id = ?
+    ''', (scope, str(scope_id)))
+    histogram = [0] * 10
+    for bucket, bucket_count in cursor.fetchall():
+        histogram[bucket] = bucket_count
+
+    average = score_sum / count if count else None
+    return {
+        "count": count,
+        "average": round(average, 2) if count else None,
+        "stddev": round(math.sqrt(max(score_sq_sum / count - average * average, 0)), 2) if count else None,
+        "histogram": histogram,
+    }
+
+# Initialize database on startup (once in the gunicorn master when run with --preload)
 with app.app_context():
     init_db()
 
@@ -108,37 +553,148 @@ def allowed_file(filename: str) -> bool:
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extract text from a PDF file."""
-    try:
-        text = ""
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                text += page.extract_text() or ""
-        return text
-    except Exception as e:
-        logger.error(f"Error extracting text from PDF: {str(e)}")
-        return ""
+class IdempotencyConflictError(ValueError):
+    """Raised when an Idempotency-Key is reused for a different analysis."""
+
+class QuotaExceededError(Exception):
+    """Raised when a user has no LLM quota left."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"LLM quota exceeded, retry in {int(retry_after) + 1} seconds")
+        self.retry_after = retry_after
+
+class QueueTimeoutError(TimeoutError):
+    """Raised when an LLM call waits in the queue for longer than LLM_QUEUE_TIMEOUT."""
+
+
+
+# Bulk import
+ImportEntry = Tuple[str, int, Callable[[], IO[bytes]]]
+
+def is_hidden_import_entry(name: str) -> bool:
+    """
+    Check if an archive or directory entry is metadata rather than a CV, such as
+    macOS resource forks (__MACOSX/._name.docx) and other dot-files.
+    """
+    parts = name.replace('\\', '/').split('/')
+    return '__MACOSX' in parts or parts[-1].startswith('.')
+
+def iter_zip_entries(archive: zipfile.ZipFile) -> Iterator[ImportEntry]:
+    """Yield (file name, size, opener) for the file entries of a ZIP archive."""
+    for info in archive.infolist():
+        if info.is_dir() or is_hidden_import_entry(info.filename):
+            continue
+        yield info.filename, info.file_size, (lambda info=info: archive.open(info))
+
+def iter_directory_entries(directory: str) -> Iterator[ImportEntry]:
+    """Yield (file name, size, opener) for every file below a directory."""
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if is_hidden_import_entry(os.path.relpath(path, directory)):
+                continue
+            yield path, os.path.getsize(path), (lambda path=path: open(path, 'rb'))
+
+def store_import_entry(name: str, size: int, opener: Callable[[], IO[bytes]]) -> Tuple[str, str]:
+    """
+    Copy one bulk import entry into the uploads folder under a unique name.
+    Returns the original (secured) file name and the stored file path.
+    """
+    original_filename = secure_filename(os.path.basename(name))
+    if not allowed_file(original_filename):
+        raise ValueError("File type not allowed")
+    if size > app.config['MAX_CONTENT_LENGTH']:
+        raise ValueError("File too large")
+
+    file_extension = original_filename.rsplit('.', 1)[1].lower()
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4()}.{file_extension}")
+    with opener() as src, open(file_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return original_filename, file_path
+
+def bulk_import_cvs(entries: Iterable[ImportEntry], user_id: int,
+                    progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Import many CVs at once.
+    Entries are stored in batches, text is extracted in a process pool and each
+    batch of cvs rows is inserted in a single transaction.
+    Returns a summary with the imported CV IDs, failures (by entry path) and throughput.
+    """
+    batch_size = app.config['BULK_IMPORT_BATCH_SIZE']
+    workers = app.config['BULK_IMPORT_WORKERS']
+    summary = {"imported": 0, "failed": 0, "cv_ids": [], "failures": []}
+    started = time.monotonic()
+
+    def flush(batch: List[Tuple[str, str, str]], executor: ProcessPoolExecutor, conn: sqlite3.Connection) -> None:
+        paths = [file_path for _, _, file_path in batch]
+        texts = executor.map(extract_import_text, paths, chunksize=max(1, len(paths) // (4 * workers)))
+        rows = []
+        for (name, file_name, file_path), (text, error) in zip(batch, texts):
+            if error:
+                os.remove(file_path)
+                summary["failed"] += 1
+                summary["failures"].append({"file": name, "error": error})
+            else:
+                rows.append((user_id, file_name, file_path, text))
+        cursor = conn.cursor()
+        for row in rows:
+            cursor.execute('''
+                INSERT INTO cvs (user_id, file_name, file_path, content, created_at)
+                VALUES (?, ?, ?, ?, datetime('now'))
+            ''', row)
+            summary["cv_ids"].append(cursor.lastrowid)
+        conn.commit()
+        summary["imported"] += len(rows)
+        logger.info(f"Bulk import: {summary['imported']} imported, {summary['failed']} failed")
+        if progress:
+            progress(summary)
+
+    # Extraction processes are not forked from this one, which runs the log writer and
+    # retention threads; forkserver children start from a clean process and only import
+    # text_extraction, which has no import-time side effects
+    start_methods = multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor, \
+            sqlite3.connect(app.config['DATABASE']) as conn:
+        batch = []
+        for name, size, opener in entries:
+            try:
+                batch.append((name, *store_import_entry(name, size, opener)))
+            except Exception as e:
+                summary["failed"] += 1
+                summary["failures"].append({"file": name, "error": str(e)})
+                continue
+            if len(batch) >= batch_size:
+                flush(batch, executor, conn)
+                batch = []
+        if batch:
+            flush(batch, executor, conn)
+
+    elapsed = time.monotonic() - started
+    summary["elapsed_seconds"] = round(elapsed, 3)
+    summary["cvs_per_minute"] = round(summary["imported"] * 60 / elapsed, 1) if elapsed else 0
+    return summary
 
-def extract_text_from_docx(file_path: str) -> str:
-    """Extract text from a DOCX file."""
+def update_import_job(job_id: int, status: str, summary: Optional[Dict[str, Any]] = None,
+                      error: Optional[str] = None) -> None:
+    """Record the status and progress of a bulk import job; a missing summary keeps the last one."""
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        conn.execute('''
+        UPDATE import_jobs SET status = ?, summary = COALESCE(?, summary), error = ?, updated_at = ?
+        WHERE id = ?
+        ''', (status, json.dumps(summary) if summary is not None else None, error, time.time(), job_id))
+
+def run_import_job(job_id: int, archive_path: str, user_id: int) -> None:
+    """Import an uploaded ZIP archive in the background, then delete it."""
     try:
-        doc = docx.Document(file_path)
-        return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        with zipfile.ZipFile(archive_path) as archive:
+            summary = bulk_import_cvs(iter_zip_entries(archive), user_id,
+                                      lambda progress: update_import_job(job_id, 'running', progress))
+        update_import_job(job_id, 'done', summary)
     except Exception as e:
-        logger.error(f"Error extracting text from DOCX: {str(e)}")
-        return ""
-
-def extract_text_from_file(file_path: str) -> str:
-    """Extract text from different file types."""
-    file_extension = file_path.split('.')[-1].lower()
-    
-    if file_extension == 'pdf':
-        return extract_text_from_pdf(file_path)
-    elif file_extension in ['docx', 'doc']:
-        return extract_text_from_docx(file_path)
-    else:
-        return ""
+        logger.error(f"Error in bulk import job {job_id}: {str(e)}")
+        update_import_job(job_id, 'failed', error=str(e))
+    finally:
+        os.remove(archive_path)
 
 
 # analyze with openai
@@ -213,50 +769,315 @@ def extract_text_from_file(file_path: str) -> str:
 #         }
 
 
+# Prompt templates
+PROMPT_TEMPLATES: Dict[str, Dict[str, Any]] = {}
+
+TRUNCATION_MARKER = "\n[... truncated ...]"
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of model tokens in a piece of text (~4 chars per token)."""
+    return (len(text) + 3) // 4
+
+def register_prompt_template(name: str, version: str, text: str) -> None:
+    """
+    Register a prompt template under a name and version.
+    The text is dedented and parsed into literal/field chunks once, so rendering
+    only has to join strings.
+    """
+    text = textwrap.dedent(text).strip()
+    parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(text)]
+    literal_text = "".join(literal for literal, _ in parts)
+    PROMPT_TEMPLATES[name] = {
+        "name": name,
+        "version": version,
+        "parts": parts,
+        "fields": [field for _, field in parts if field],
+        "base_tokens": estimate_tokens(literal_text),
+    }
+
+def trim_to_token_budget(text: str, max_tokens: int) -> str:
+    """
+    Deterministically trim text to fit an estimated token budget.
+    Keeps the head of the text, cutting at the last line break when one is close
+    to the limit, and appends a truncation marker.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(0, max_tokens * 4 - len(TRUNCATION_MARKER))
+    cut = text[:max_chars]
+    newline = cut.rfind("\n")
+    if newline >= max_chars * 0.8:
+        cut = cut[:newline]
+    return cut.rstrip() + TRUNCATION_MARKER
+
+def allocate_token_budget(sizes: Dict[str, int], budget: int) -> Dict[str, int]:
+    """
+    Split a token budget across fields so that small fields are kept whole and
+    the remainder is shared equally among the larger ones.
+    """
+    allocation = {}
+    remaining = max(0, budget)
+    pending = sorted(sizes, key=lambda name: (sizes[name], name))
+    while pending:
+        share = remaining // len(pending)
+        name = pending.pop(0)
+        allocation[name] = min(sizes[name], share)
+        remaining -= allocation[name]
+    return allocation
+
+def render_prompt(name: str, **values: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Render a registered prompt template, trimming the values if the estimated
+    prompt size exceeds PROMPT_TOKEN_BUDGET.
+    Returns the prompt and metadata identifying the template and model.
+    """
+    template = PROMPT_TEMPLATES[name]
+    sizes = {field: estimate_tokens(values[field]) for field in template["fields"]}
+    available = app.config['PROMPT_TOKEN_BUDGET'] - template["base_tokens"]
+    trimmed = False
+
+    if sum(sizes.values()) > available:
+        allocation = allocate_token_budget(sizes, available)
+        for field, max_tokens in allocation.items():
+            if max_tokens < sizes[field]:
+                values[field] = trim_to_token_budget(values[field], max_tokens)
+                trimmed = True
+
+    prompt = "".join(literal + (values[field] if field else "") for literal, field in template["parts"])
+    metadata = {
+        "prompt_template": template["name"],
+        "prompt_version": template["version"],
+        "model": app.config['GEMINI_MODEL'],
+        "prompt_tokens": estimate_tokens(prompt),
+        "prompt_trimmed": trimmed,
+    }
+    return prompt, metadata
+
+register_prompt_template("cv_analysis", "1", """
+    You are an expert CV/resume analyzer and job application specialist. Your task is to provide detailed analysis on how well a CV matches a job description.
+
+    JOB DESCRIPTION:
+    {job_description}
+
+    CV CONTENT:
+    {cv_text}
+
+    Please provide the following in a JSON format:
+    1. A match score from 0 to 100 representing how well the CV matches the job requirements.
+    2. Detailed feedback on the CV's strengths and weaknesses relative to the job description.
+    3. Specific suggestions for improvement, including:
+    - Skills or experiences to highlight
+    - Sections to add or modify
+    - Keywords to include
+    - Formatting recommendations
+    4. A revised version of the CV that better matches the job description.
+
+    Format your response as a valid JSON object with the following keys:
+    - "score": (number)
+    - "feedback": (string with detailed analysis)
+    - "suggestions": (array of specific improvement points)
+    - "improved_cv": (string with the revised CV text)
+    """)
+
+register_prompt_template("cv_reanalysis", "1", """
+    You are an expert CV/resume analyzer and job application specialist. A candidate has edited a CV that you previously analyzed against the job description below. Only the sections listed under CHANGED SECTIONS were edited; every other section is unchanged.
+
+    JOB DESCRIPTION:
+    {job_description}
+
+    PREVIOUS ANALYSIS:
+    Score: {previous_score}
+    Feedback: {previous_feedback}
+
+    CHANGED SECTIONS:
+    {changed_sections}
+
+    Reassess the CV taking the edits into account.
+
+    Format your response as a valid JSON object with the following keys:
+    - "score": (number from 0 to 100, the updated overall match score)
+    - "feedback": (string with updated detailed analysis of the whole CV)
+    - "suggestions": (array of specific improvement points)
+    - "improved_sections": (object mapping each changed section heading, exactly as given, to its revised text)
+    """)
+
+
+@lru_cache(maxsize=None)
+def get_gemini_model(model_name: str) -> Any:
+    """
+    Return a Gemini model client, importing and configuring google.generativeai
+    on first use so that app startup and forked workers do not pay for it.
+    """
+    import google.generativeai as genai
+
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY", "your-api-key"))
+    return genai.GenerativeModel(model_name)
+
+# CV versions
+CV_SECTION_HEADINGS = re.compile(
+    r'^(profile|summary|professional summary|objective|about me|experience|work experience|'
+    r'professional experience|employment( history)?|education|skills|technical skills|projects|'
+    r'certifications?|awards|publications|languages|interests|volunteering|references)\s*:?$',
+    re.IGNORECASE
+)
+
+def is_cv_section_heading(line: str) -> bool:
+    """Guess whether a line of CV text is a section heading."""
+    line = line.strip()
+    if not line or len(line) > 40:
+        return False
+    return bool(CV_SECTION_HEADINGS.match(line)) or (line.isupper() and any(c.isalpha() for c in line))
+
+def split_cv_sections(text: str) -> List[Tuple[str, str, str]]:
+    """
+    Split CV text into sections at heading lines.
+    Returns (key, heading, body) tuples in order; text before the first heading
+    is a section with an empty heading, and repeated headings get numbered keys.
+    """
+    sections = []
+    heading, lines = "", []
+    for line in text.splitlines():
+        if is_cv_section_heading(line):
+            if heading or any(l.strip() for l in lines):
+                sections.append((heading, "\n".join(lines).strip()))
+            heading, lines = line.strip(), []
+        else:
+            lines.append(line)
+    sections.append((heading, "\n".join(lines).strip()))
+
+    keyed, seen = [], {}
+    for heading, body in sections:
+        key = heading.lower().rstrip(':').strip()
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = f"{key}#{seen[key]}"
+        keyed.append((key, heading, body))
+    return keyed
+
+def diff_cv_sections(old_text: str, new_text: str) -> Dict[str, Any]:
+    """
+    Compare two versions of a CV section by section.
+    Returns the new sections, the keys of changed (edited, added or removed)
+    sections with their old and new bodies, and the fraction of the new CV that changed.
+    """
+    old_sections = {key: body for key, _, body in split_cv_sections(old_text)}
+    new_sections = split_cv_sections(new_text)
+    changed = {}
+    for key, heading, body in new_sections:
+        old_body = old_sections.get(key)
+        if old_body is None or " ".join(old_body.split()) != " ".join(body.split()):
+            changed[key] = {"heading": heading, "old": old_body, "new": body}
+    new_keys = {key for key, _, _ in new_sections}
+    for key, body in old_sections.items():
+        if key not in new_keys:
+            changed[key] = {"heading": key, "old": body, "new": None}
+
+    changed_chars = sum(len(change["new"] or change["old"] or "") for change in changed.values())
+    return {
+        "sections": new_sections,
+        "changed": changed,
+        "changed_ratio": changed_chars / max(len(new_text), 1),
+    }
+
+def format_changed_sections(changed: Dict[str, Dict[str, Any]]) -> str:
+    """Describe changed CV sections for the reanalysis prompt as per-section unified diffs plus new text."""
+    parts = []
+    for change in changed.values():
+        heading = change["heading"] or "(top of CV)"
+        if change["new"] is None:
+            parts.append(f"## {heading}\n(section removed)")
+            continue
+        if change["old"] is None:
+            parts.append(f"## {heading}\n(new section)\n{change['new']}")
+            continue
+        diff = "\n".join(difflib.unified_diff(
+            change["old"].splitlines(), change["new"].splitlines(), lineterm="", n=1
+        ))
+        parts.append(f"## {heading}\nDIFF:\n{diff}\nNEW TEXT:\n{change['new']}")
+    return "\n\n".join(parts)
+
+def merge_improved_sections(previous_improved_cv: str, sections: List[Tuple[str, str, str]],
+                            changed: Dict[str, Dict[str, Any]], improved_sections: Dict[str, str]) -> str:
+    """
+    Build the improved CV for a new version: unchanged sections keep their
+    previously improved text, changed ones take the revised text from the model.
+    """
+    previous = {key: (heading, body) for key, heading, body in split_cv_sections(previous_improved_cv)}
+    improved_by_heading = {str(heading).lower().rstrip(':').strip(): text for heading, text in improved_sections.items()}
+    parts = []
+    for key, heading, body in sections:
+        if key in changed:
+            body = improved_by_heading.get(key.split('#')[0], body)
+        elif key in previous:
+            heading, body = previous[key]
+        parts.append(f"{heading}\n{body}" if heading else body)
+    return "\n\n".join(part for part in parts if part.strip())
+
+def find_base_analysis(cv_id: int, job_description: str) -> Optional[Dict[str, Any]]:
+    """
+    Find the latest successful analysis of the previous version of a CV against
+    the same job description text, with that version's CV text. Both versions and
+    the analysis must belong to the same signed-in user.
+    """
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT ar.id, ar.score, ar.feedback, ar.suggestions, ar.improved_cv,
+               ar.prompt_template, ar.prompt_version, ar.model, prev.content AS cv_content
+        FROM cvs cur
+        JOIN cvs prev ON prev.id = cur.previous_cv_id
+        JOIN analysis_results ar ON ar.cv_id = prev.id
+        JOIN job_descriptions jd ON jd.id = ar.job_description_id
+        WHERE cur.id = ? AND jd.content = ? AND ar.status = 'ok'
+          AND cur.user_id != 0 AND prev.user_id = cur.user_id AND ar.user_id = cur.user_id
+        ORDER BY ar.id DESC
+        LIMIT 1
+        ''', (cv_id, job_description))
+        row = cursor.fetchone()
+
+    if not row:
+        return None
+    base = dict(row)
+    base['suggestions'] = json.loads(row['suggestions']) if row['suggestions'] else []
+    return base
+
 # analyze with gemini
+def generate_json_with_gemini(prompt: str, model_name: str) -> Dict[str, Any]:
+    """Send a prompt to Gemini and parse the JSON object in its response."""
+    model = get_gemini_model(model_name)
+    response = model.generate_content(prompt)
+    content = response.text.strip()
+
+    # Clean response if wrapped in code block
+    if "```json" in content:
+        content = re.search(r'```json\s*([\s\S]*?)\s*```', content).group(1)
+    elif "```" in content:
+        content = re.search(r'```\s*([\s\S]*?)\s*```', content).group(1)
+
+    return json.loads(content)
+
 def analyze_cv_with_gemini(cv_text: str, job_description: str) -> Dict[str, Any]:
     """
     Analyze the CV against a job description using Gemini API.
-    Returns a dictionary with score, feedback, suggestions, and improved CV.
+    Returns a dictionary with score, feedback, suggestions, and improved CV,
+    plus the prompt template/model metadata used to produce them.
     """
+    metadata = {
+        "prompt_template": app.config['PROMPT_TEMPLATE'],
+        "prompt_version": None,
+        "model": app.config['GEMINI_MODEL'],
+    }
     try:
-        prompt = f"""
-        You are an expert CV/resume analyzer and job application specialist. Your task is to provide detailed analysis on how well a CV matches a job description.
-
-        JOB DESCRIPTION:
-        {job_description}
-
-        CV CONTENT:
-        {cv_text}
-
-        Please provide the following in a JSON format:
-        1. A match score from 0 to 100 representing how well the CV matches the job requirements.
-        2. Detailed feedback on the CV's strengths and weaknesses relative to the job description.
-        3. Specific suggestions for improvement, including:
-        - Skills or experiences to highlight
-        - Sections to add or modify
-        - Keywords to include
-        - Formatting recommendations
-        4. A revised version of the CV that better matches the job description.
-
-        Format your response as a valid JSON object with the following keys:
-        - "score": (number)
-        - "feedback": (string with detailed analysis)
-        - "suggestions": (array of specific improvement points)
-        - "improved_cv": (string with the revised CV text)
-        """
-
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        content = response.text.strip()
-
-        # Clean response if wrapped in code block
-        if "```json" in content:
-            content = re.search(r'```json\s*([\s\S]*?)\s*```', content).group(1)
-        elif "```" in content:
-            content = re.search(r'```\s*([\s\S]*?)\s*```', content).group(1)
-
-        result = json.loads(content)
+        prompt, metadata = render_prompt(
+            app.config['PROMPT_TEMPLATE'],
+            job_description=job_description,
+            cv_text=cv_text,
+        )
+        if metadata["prompt_trimmed"]:
+            logger.warning(f"Prompt trimmed to fit token budget ({metadata['prompt_tokens']} tokens)")
+
+        result = generate_json_with_gemini(prompt, metadata["model"])
 
         # Ensure all required fields are present
         required_fields = ["score", "feedback", "suggestions", "improved_cv"]
@@ -264,6 +1085,8 @@ def analyze_cv_with_gemini(cv_text: str, job_description: str) -> Dict[str, Any]
             if field not in result:
                 result[field] = "" if field != "suggestions" else []
 
+        result.update(metadata)
+        result["status"] = "ok"
         return result
 
     except Exception as e:
@@ -272,9 +1095,68 @@ def analyze_cv_with_gemini(cv_text: str, job_description: str) -> Dict[str, Any]
             "score": 0,
             "feedback": f"An error occurred during analysis: {str(e)}",
             "suggestions": ["Unable to provide suggestions due to an error."],
-            "improved_cv": cv_text
+            "improved_cv": cv_text,
+            "status": "error",
+            **metadata
         }
 
+def reanalyze_cv_with_gemini(cv_text: str, job_description: str, base: Dict[str, Any],
+                             changes: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reanalyze a new version of a CV by sending Gemini only its changed sections
+    together with the previous analysis. Falls back to a full analysis on error.
+    """
+    try:
+        prompt, metadata = render_prompt(
+            app.config['REANALYSIS_PROMPT_TEMPLATE'],
+            job_description=job_description,
+            previous_score=str(base['score']),
+            previous_feedback=base['feedback'] or "",
+            changed_sections=format_changed_sections(changes['changed']),
+        )
+        result = generate_json_with_gemini(prompt, metadata["model"])
+
+        improved_sections = result.get("improved_sections")
+        if not isinstance(improved_sections, dict):
+            improved_sections = {}
+
+        return {
+            "score": result.get("score", base['score']),
+            "feedback": result.get("feedback", base['feedback']),
+            "suggestions": result.get("suggestions", base['suggestions']),
+            "improved_cv": merge_improved_sections(
+                base['improved_cv'] or "", changes['sections'], changes['changed'], improved_sections
+            ),
+            "base_result_id": base['id'],
+            "status": "ok",
+            **metadata
+        }
+
+    except Exception as e:
+        logger.error(f"Error in Gemini reanalysis, running a full analysis: {str(e)}")
+        return analyze_cv_with_gemini(cv_text, job_description)
+
+def run_cv_analysis(cv_id: int, cv_text: str, job_description: str, user_id: int) -> Dict[str, Any]:
+    """
+    Analyze a CV against a job description, reusing the analysis of its previous
+    version when there is one: an unchanged CV reuses the previous result without
+    an LLM call, and a CV with small edits is reanalyzed from its changed sections.
+    """
+    base = find_base_analysis(cv_id, job_description)
+    changes = diff_cv_sections(base['cv_content'] or "", cv_text) if base else None
+
+    if changes is not None and not changes['changed']:
+        result = {key: base[key] for key in (
+            'score', 'feedback', 'suggestions', 'improved_cv', 'prompt_template', 'prompt_version', 'model', 'status'
+        )}
+        result['base_result_id'] = base['id']
+        return result
+
+    with llm_slot(user_id), log_stage('llm'):
+        if changes is not None and changes['changed_ratio'] <= app.config['REANALYSIS_MAX_CHANGED_RATIO']:
+            return reanalyze_cv_with_gemini(cv_text, job_description, base, changes)
+        return analyze_cv_with_gemini(cv_text, job_description)
+
 
 def save_analysis_result(user_id: int, cv_id: int, job_description_id: int, result: Dict[str, Any]) -> int:
     """Save analysis result to database and return the result ID."""
@@ -283,8 +1165,9 @@ def save_analysis_result(user_id: int, cv_id: int, job_description_id: int, resu
             cursor = conn.cursor()
             cursor.execute('''
             INSERT INTO analysis_results 
-            (user_id, cv_id, job_description_id, score, feedback, suggestions, improved_cv, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            (user_id, cv_id, job_description_id, score, feedback, suggestions, improved_cv,
+             prompt_template, prompt_version, model, base_result_id, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
             ''', (
                 user_id,
                 cv_id,
@@ -293,6 +1176,11 @@ def save_analysis_result(user_id: int, cv_id: int, job_description_id: int, resu
                 result.get('feedback', ''),
                 json.dumps(result.get('suggestions', [])),
                 result.get('improved_cv', ''),
+                result.get('prompt_template'),
+                result.get('prompt_version'),
+                result.get('model'),
+                result.get('base_result_id'),
+                result.get('status', 'ok'),
             ))
             conn.commit()
             return cursor.lastrowid
@@ -300,6 +1188,540 @@ def save_analysis_result(user_id: int, cv_id: int, job_description_id: int, resu
         logger.error(f"Error saving analysis result: {str(e)}")
         return -1
 
+def load_analysis_result(result_id: int) -> Dict[str, Any]:
+    """Load a saved analysis result in the shape returned by analyze_cv_with_gemini()."""
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT score, feedback, suggestions, improved_cv, prompt_template, prompt_version, model, base_result_id, status
+        FROM analysis_results
+        WHERE id = ?
+        ''', (result_id,))
+        row = cursor.fetchone()
+
+    result = dict(row)
+    result['suggestions'] = json.loads(row['suggestions']) if row['suggestions'] else []
+    return result
+
+# Idempotency and in-flight coalescing of analyses
+in_flight_analyses: Dict[str, Tuple[str, Future]] = {}
+in_flight_lock = threading.Lock()
+
+def claim_analysis_request(request_key: str, fingerprint: str) -> Tuple[bool, Optional[int]]:
+    """
+    Try to claim an analysis request key across all workers.
+    Returns (claimed, result_id). When claimed is False, result_id is the finished
+    result, or None while another caller is still running the analysis.
+    """
+    now = time.time()
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO analysis_requests (request_key, fingerprint, result_id, expires_at)
+        VALUES (?, ?, NULL, ?)
+        ON CONFLICT (request_key) DO UPDATE SET
+            fingerprint = excluded.fingerprint,
+            result_id = NULL,
+            expires_at = excluded.expires_at
+        WHERE analysis_requests.expires_at < ?
+        ''', (request_key, fingerprint, now + app.config['ANALYSIS_CLAIM_TIMEOUT'], now))
+        if cursor.rowcount == 1:
+            conn.commit()
+            return True, None
+
+        cursor.execute('SELECT fingerprint, result_id FROM analysis_requests WHERE request_key = ?', (request_key,))
+        row = cursor.fetchone()
+
+    if not row:
+        return False, None
+    if row[0] != fingerprint:
+        raise IdempotencyConflictError("Idempotency-Key was already used for a different analysis")
+    return False, row[1]
+
+def finish_analysis_request(request_key: str, result_id: int, ttl: float) -> None:
+    """Record the result of a claimed request (or release the claim on failure) and prune expired keys."""
+    now = time.time()
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        cursor = conn.cursor()
+        if result_id == -1:
+            cursor.execute('DELETE FROM analysis_requests WHERE request_key = ?', (request_key,))
+        else:
+            cursor.execute('''
+            UPDATE analysis_requests SET result_id = ?, expires_at = ? WHERE request_key = ?
+            ''', (result_id, now + ttl, request_key))
+        cursor.execute('DELETE FROM analysis_requests WHERE expires_at < ?', (now,))
+        conn.commit()
+
+def find_idempotent_result(request_key: str, fingerprint: str) -> Optional[int]:
+    """Return the result recorded for an Idempotency-Key, or None if the key is new or expired."""
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT fingerprint, result_id FROM analysis_requests WHERE request_key = ? AND expires_at >= ?
+        ''', (request_key, time.time()))
+        row = cursor.fetchone()
+
+    if not row or row[1] is None:
+        return None
+    if row[0] != fingerprint:
+        raise IdempotencyConflictError("Idempotency-Key was already used for a different analysis")
+    return row[1]
+
+def remember_idempotent_result(request_key: str, fingerprint: str, result_id: int) -> None:
+    """Record the result of an analysis under its Idempotency-Key for IDEMPOTENCY_KEY_TTL."""
+    now = time.time()
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        conn.execute('''
+        INSERT INTO analysis_requests (request_key, fingerprint, result_id, expires_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (request_key) DO UPDATE SET
+            fingerprint = excluded.fingerprint,
+            result_id = excluded.result_id,
+            expires_at = excluded.expires_at
+        WHERE analysis_requests.expires_at < ? OR analysis_requests.result_id IS NULL
+        ''', (request_key, fingerprint, result_id, now + app.config['IDEMPOTENCY_KEY_TTL'], now))
+
+def run_analysis_once(request_key: str, fingerprint: str, ttl: float,
+                      analyze: Callable[[], Tuple[int, Dict[str, Any]]]) -> Tuple[int, Dict[str, Any]]:
+    """
+    Run an analysis at most once per request key.
+    Concurrent callers in this process wait on the same future; callers in other
+    workers wait for the claim in analysis_requests. Everyone gets the same
+    (result_id, analysis), and finished results are replayed until ttl expires.
+    """
+    with in_flight_lock:
+        in_flight = in_flight_analyses.get(request_key)
+        if not in_flight:
+            in_flight = in_flight_analyses[request_key] = (fingerprint, Future())
+            owner = True
+        else:
+            owner = False
+
+    in_flight_fingerprint, future = in_flight
+    if not owner:
+        if in_flight_fingerprint != fingerprint:
+            raise IdempotencyConflictError("Idempotency-Key was already used for a different analysis")
+        return future.result()
+
+    try:
+        deadline = time.monotonic() + app.config['ANALYSIS_WAIT_TIMEOUT']
+        while True:
+            claimed, result_id = claim_analysis_request(request_key, fingerprint)
+            if claimed:
+                break
+            if result_id is not None:
+                future.set_result((result_id, load_analysis_result(result_id)))
+                return future.result()
+            if time.monotonic() > deadline:
+                raise TimeoutError("An identical analysis is still in progress")
+            time.sleep(app.config['ANALYSIS_POLL_INTERVAL'])
+
+        try:
+            result_id, analysis = analyze()
+        except Exception:
+            finish_analysis_request(request_key, -1, ttl)
+            raise
+        # Failed analyses are returned to the callers already waiting, but not shared afterwards
+        failed = result_id == -1 or analysis.get('status') == 'error'
+        finish_analysis_request(request_key, -1 if failed else result_id, ttl)
+        future.set_result((result_id, analysis))
+        return future.result()
+
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with in_flight_lock:
+            in_flight_analyses.pop(request_key, None)
+
+# LLM scheduling
+def get_quota_client(cursor: sqlite3.Cursor, user_id: Optional[int]) -> Tuple[str, str]:
+    """
+    Return the quota bucket key and tier name for an LLM call. Registered users are
+    charged per account; anonymous callers (user_id 0, null or unknown) per client IP.
+    """
+    cursor.execute('SELECT tier FROM users WHERE id = ?', (user_id,))
+    row = cursor.fetchone()
+    if row:
+        tier = row[0] if row[0] in app.config['LLM_TIERS'] else app.config['LLM_DEFAULT_TIER']
+        return f"user:{user_id}", tier
+    client_ip = request.remote_addr if has_request_context() else None
+    return f"ip:{client_ip or 'unknown'}", app.config['LLM_ANONYMOUS_TIER']
+
+def refill_llm_tokens(tokens: float, updated_at: float, tier: Dict[str, Any], now: float) -> float:
+    """Return the tokens in a bucket at time now, after refilling since updated_at."""
+    return min(tier['burst'], tokens + (now - updated_at) * tier['per_minute'] / 60)
+
+def consume_llm_quota(cursor: sqlite3.Cursor, quota_key: str, tier_name: str, now: float) -> None:
+    """Take one call from a token bucket, raising QuotaExceededError if it is empty."""
+    tier = app.config['LLM_TIERS'][tier_name]
+    cursor.execute('''
+    INSERT INTO llm_quota_buckets (quota_key, tier, tokens, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (quota_key) DO UPDATE SET tier = excluded.tier
+    ''', (quota_key, tier_name, tier['burst'], now))
+    cursor.execute('SELECT tokens, updated_at FROM llm_quota_buckets WHERE quota_key = ?', (quota_key,))
+    tokens, updated_at = cursor.fetchone()
+    tokens = refill_llm_tokens(tokens, updated_at, tier, now)
+
+    if tokens < 1:
+        cursor.execute('UPDATE llm_quota_buckets SET rejected_total = rejected_total + 1 WHERE quota_key = ?',
+                       (quota_key,))
+        raise QuotaExceededError((1 - tokens) * 60 / tier['per_minute'])
+
+    cursor.execute('''
+    UPDATE llm_quota_buckets SET tokens = ?, updated_at = ?, calls_total = calls_total + 1 WHERE quota_key = ?
+    ''', (tokens - 1, now, quota_key))
+
+@contextmanager
+def llm_slot(user_id: int) -> Iterator[None]:
+    """
+    Hold one of the LLM_MAX_CONCURRENT slots shared by all workers.
+    The caller's quota is charged on entry; waiting calls are started by tier
+    priority, then round-robin by the time each quota bucket was last served.
+    """
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=30, isolation_level=None)
+    entry_id = None
+    try:
+        cursor = conn.cursor()
+        now = time.time()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            quota_key, tier_name = get_quota_client(cursor, user_id)
+            consume_llm_quota(cursor, quota_key, tier_name, now)
+        except QuotaExceededError:
+            cursor.execute('COMMIT')
+            raise
+        cursor.execute('''
+        INSERT INTO llm_queue (user_id, quota_key, priority, enqueued_at, lease_expires) VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, quota_key, app.config['LLM_TIERS'][tier_name]['priority'], now,
+              now + app.config['LLM_LEASE_SECONDS']))
+        entry_id = cursor.lastrowid
+        cursor.execute('COMMIT')
+
+        with log_stage('queue'):
+            deadline = time.monotonic() + app.config['LLM_QUEUE_TIMEOUT']
+            while True:
+                now = time.time()
+                cursor.execute('BEGIN IMMEDIATE')
+                # Drop entries left behind by workers that died
+                cursor.execute('DELETE FROM llm_queue WHERE lease_expires < ?', (now,))
+                cursor.execute('SELECT COUNT(*) FROM llm_queue WHERE started_at IS NOT NULL')
+                free_slots = app.config['LLM_MAX_CONCURRENT'] - cursor.fetchone()[0]
+                cursor.execute('''
+                SELECT q.id
+                FROM llm_queue q
+                LEFT JOIN llm_quota_buckets b ON b.quota_key = q.quota_key
+                WHERE q.started_at IS NULL
+                ORDER BY q.priority, COALESCE(b.last_served_at, 0), q.id
+                LIMIT ?
+                ''', (max(free_slots, 0),))
+                if entry_id in {row[0] for row in cursor.fetchall()}:
+                    cursor.execute('''
+                    UPDATE llm_queue SET started_at = ?, lease_expires = ? WHERE id = ?
+                    ''', (now, now + app.config['LLM_LEASE_SECONDS'], entry_id))
+                    cursor.execute('UPDATE llm_quota_buckets SET last_served_at = ? WHERE quota_key = ?',
+                                   (now, quota_key))
+                    cursor.execute('COMMIT')
+                    break
+                cursor.execute('UPDATE llm_queue SET lease_expires = ? WHERE id = ?',
+                               (now + app.config['LLM_LEASE_SECONDS'], entry_id))
+                cursor.execute('COMMIT')
+
+                if time.monotonic() > deadline:
+                    # The call never ran, so give back the quota it was charged
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute('''
+                    UPDATE llm_quota_buckets SET tokens = MIN(tokens + 1, ?), calls_total = calls_total - 1
+                    WHERE quota_key = ?
+                    ''', (app.config['LLM_TIERS'][tier_name]['burst'], quota_key))
+                    cursor.execute('COMMIT')
+                    raise QueueTimeoutError("The analysis queue is full, please try again later")
+                time.sleep(app.config['LLM_POLL_INTERVAL'])
+
+        yield
+
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        if entry_id is not None:
+            conn.execute('DELETE FROM llm_queue WHERE id = ?', (entry_id,))
+        conn.close()
+
+# CV export renderers
+def render_txt(text: str) -> bytes:
+    """Render CV text as a UTF-8 text file."""
+    return text.encode('utf-8')
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+# Characters outside the XML 1.0 Char production, which no XML document may contain
+XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+def render_docx(text: str) -> bytes:
+    """
+    Render CV text as a minimal DOCX document, one paragraph per line.
+    Control characters that XML cannot represent (e.g. from PDF extraction) are dropped.
+    """
+    paragraphs = "".join(
+        f'<w:p><w:r><w:t xml:space="preserve">{xml_escape(XML_INVALID_CHARS.sub("", line))}</w:t></w:r></w:p>'
+        for line in text.splitlines()
+    )
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:document xmlns:w="{W_NS[1:-1]}"><w:body>{paragraphs}</w:body></w:document>'
+    )
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', DOCX_RELS)
+        archive.writestr('word/document.xml', document)
+    return buffer.getvalue()
+
+# A4 page in points, with a 10pt Helvetica body
+PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT, PDF_MARGIN = 595, 842, 56
+PDF_FONT_SIZE, PDF_LEADING, PDF_CHARS_PER_LINE = 10, 13, 95
+
+def pdf_escape(line: str) -> str:
+    """Escape a line of text for use in a PDF string literal."""
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def render_pdf(text: str) -> bytes:
+    """
+    Render CV text as a paginated PDF using the built-in Helvetica font.
+    Text is encoded as Windows-1252, which matches the font's WinAnsiEncoding and so
+    keeps bullets, dashes and curly quotes; characters outside it are replaced.
+    """
+    lines = []
+    for line in text.splitlines():
+        lines.extend(textwrap.wrap(line, PDF_CHARS_PER_LINE, replace_whitespace=False) or [""])
+    lines_per_page = (PDF_PAGE_HEIGHT - 2 * PDF_MARGIN) // PDF_LEADING
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+    # Objects 1-3 are the catalog, page tree and font; each page adds a page and a content stream
+    objects = [b"", b"", b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    page_ids = []
+    for page in pages:
+        body = "".join(f"({pdf_escape(line)}) Tj T*\n" for line in page)
+        stream = (
+            f"BT /F1 {PDF_FONT_SIZE} Tf {PDF_LEADING} TL "
+            f"{PDF_MARGIN} {PDF_PAGE_HEIGHT - PDF_MARGIN} Td\n{body}ET"
+        ).encode('cp1252', 'replace')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT, len(objects))
+        )
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(pdf)
+
+EXPORT_FORMATS = {
+    'txt': ('text/plain; charset=utf-8', render_txt),
+    'docx': ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', render_docx),
+    'pdf': ('application/pdf', render_pdf),
+}
+
+@lru_cache(maxsize=app.config['EXPORT_CACHE_SIZE'])
+def render_export(result_id: int, format_type: str) -> Tuple[bytes, str]:
+    """
+    Render the improved CV of an analysis result in the given format.
+    Returns the file content and download name; results are cached per worker
+    since a stored analysis result never changes. Callers check that the result
+    still exists first, as retention may have archived it in another worker.
+    Raises LookupError if the result does not exist.
+    """
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT ar.improved_cv, c.file_name
+        FROM analysis_results ar
+        JOIN cvs c ON ar.cv_id = c.id
+        WHERE ar.id = ?
+        ''', (result_id,))
+        row = cursor.fetchone()
+
+    if not row:
+        raise LookupError("Analysis result not found")
+
+    original_filename = row['file_name'].rsplit('.', 1)[0]  # Remove extension
+    _, renderer = EXPORT_FORMATS[format_type]
+    return renderer(row['improved_cv'] or ""), f"{original_filename}_improved.{format_type}"
+
+# Retention and maintenance
+def database_size(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """Return the database size and its free (reclaimable) space in bytes."""
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return page_count * page_size, freelist_count * page_size
+
+def archive_old_results(conn: sqlite3.Connection) -> Dict[str, Any]:
+    """
+    Move analysis results older than RETENTION_DAYS to a gzipped JSON lines file.
+    Rows are written to the archive before they are deleted, one batch per transaction,
+    and are flagged as archived so that the analytics rollups keep counting them.
+    """
+    cutoff = (datetime.utcnow() - timedelta(days=app.config['RETENTION_DAYS'])).strftime('%Y-%m-%d %H:%M:%S')
+    archive_path = os.path.join(
+        app.config['ARCHIVE_FOLDER'], f"analysis_results-{datetime.utcnow():%Y%m%d-%H%M%S}.jsonl.gz"
+    )
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    archived = 0
+
+    while True:
+        rows = cursor.execute('''
+        SELECT * FROM analysis_results WHERE created_at < ? ORDER BY created_at LIMIT ?
+        ''', (cutoff, app.config['RETENTION_BATCH_SIZE'])).fetchall()
+        if not rows:
+            break
+
+        os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+        with gzip.open(archive_path, 'at', encoding='utf-8') as archive:
+            for row in rows:
+                archive.write(json.dumps(dict(row)) + "\n")
+
+        ids = [row['id'] for row in rows]
+        placeholders = ",".join("?" * len(ids))
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute(f'DELETE FROM analysis_requests WHERE result_id IN ({placeholders})', ids)
+            conn.execute(f'UPDATE analysis_results SET archived = 1 WHERE id IN ({placeholders})', ids)
+            conn.execute(f'DELETE FROM analysis_results WHERE id IN ({placeholders})', ids)
+        archived += len(ids)
+        time.sleep(app.config['RETENTION_BATCH_PAUSE'])
+
+    return {"archived_results": archived, "archive_file": archive_path if archived else None}
+
+def delete_orphaned_uploads(conn: sqlite3.Connection) -> Dict[str, Any]:
+    """
+    Delete files in the uploads folder that no cvs row references.
+    Recent files are kept, since an upload is saved before its row is inserted.
+    """
+    referenced = {os.path.basename(file_path) for (file_path,) in conn.execute('SELECT file_path FROM cvs')}
+    cutoff = time.time() - app.config['ORPHAN_UPLOAD_GRACE']
+    deleted, freed = 0, 0
+
+    for entry in os.scandir(app.config['UPLOAD_FOLDER']):
+        if not entry.is_file() or entry.name in referenced:
+            continue
+        stat = entry.stat()
+        if stat.st_mtime < cutoff:
+            os.remove(entry.path)
+            deleted += 1
+            freed += stat.st_size
+
+    return {"deleted_uploads": deleted, "upload_bytes_freed": freed}
+
+def vacuum_incrementally(conn: sqlite3.Connection, full: bool = False) -> Dict[str, Any]:
+    """
+    Return free pages to the file system a few at a time, then refresh query
+    planner statistics. A full VACUUM (which blocks writers) is only run on request,
+    and is needed once to switch an existing database to incremental auto-vacuum.
+    """
+    size_before, _ = database_size(conn)
+    if full:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    elif conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+            # execute() steps the pragma once, freeing a single page; executescript runs it to completion
+            conn.executescript(f"PRAGMA incremental_vacuum({app.config['VACUUM_PAGES_PER_STEP']});")
+            time.sleep(app.config['RETENTION_BATCH_PAUSE'])
+    # Measured before optimize, whose new statistics pages would count against the space freed;
+    # other workers may still grow the file meanwhile, so the result is never reported as negative
+    size_after, free_after = database_size(conn)
+    conn.execute('PRAGMA analysis_limit = 400')
+    conn.execute('PRAGMA optimize')
+
+    return {
+        "database_bytes": size_after,
+        "database_bytes_freed": max(size_before - size_after, 0),
+        "database_bytes_reclaimable": free_after,
+    }
+
+def run_retention(full_vacuum: bool = False) -> Dict[str, Any]:
+    """Archive old results, delete orphaned uploads and vacuum the database; returns a report."""
+    started = time.monotonic()
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=30, isolation_level=None)
+    try:
+        report = {}
+        report.update(archive_old_results(conn))
+        report.update(delete_orphaned_uploads(conn))
+        report.update(vacuum_incrementally(conn, full_vacuum))
+    finally:
+        conn.close()
+    report["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    logger.info(f"Retention run: {json.dumps(report)}")
+    return report
+
+def acquire_maintenance_lease(name: str, duration: float) -> bool:
+    """Take a named lease shared by all workers; returns False if another worker holds it."""
+    now = time.time()
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO maintenance_leases (name, expires_at) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET expires_at = excluded.expires_at
+        WHERE maintenance_leases.expires_at < ?
+        ''', (name, now + duration, now))
+        conn.commit()
+        return cursor.rowcount == 1
+
+def retention_scheduler_loop() -> None:
+    """Run retention every RETENTION_INTERVAL seconds in whichever worker holds the lease."""
+    while True:
+        time.sleep(app.config['RETENTION_INTERVAL'])
+        try:
+            if acquire_maintenance_lease('retention', app.config['RETENTION_INTERVAL'] * 0.9):
+                run_retention()
+        except Exception as e:
+            logger.error(f"Error in retention run: {str(e)}")
+
+retention_scheduler_pid = None
+retention_scheduler_lock = threading.Lock()
+
+@app.before_request
+def start_retention_scheduler() -> None:
+    """Start the retention thread in this process on its first request."""
+    global retention_scheduler_pid
+    if retention_scheduler_pid == os.getpid() or not app.config['RETENTION_INTERVAL']:
+        return
+    with retention_scheduler_lock:
+        if retention_scheduler_pid != os.getpid():
+            retention_scheduler_pid = os.getpid()
+            threading.Thread(target=retention_scheduler_loop, name='retention', daemon=True).start()
+
 # Routes
 @app.route('/', methods=['GET'])
 def home():
@@ -310,6 +1732,65 @@ def health_check():
     """Health check endpoint."""
     return jsonify({"status": "healthy", "version": "1.0.0"})
 
+@app.route('/api/llm-usage', methods=['GET'])
+def get_llm_usage():
+    """
+    Endpoint to report LLM queue depth and quota usage per user account or anonymous client IP.
+    Optional: user_id as query parameter to report a single user
+    """
+    try:
+        user_id = request.args.get('user_id')
+        quota_key = f"user:{user_id}" if user_id else None
+        now = time.time()
+        
+        with sqlite3.connect(app.config['DATABASE']) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+            SELECT COUNT(*) - COUNT(started_at) AS waiting, COUNT(started_at) AS running
+            FROM llm_queue
+            WHERE lease_expires >= ?
+            ''', (now,))
+            queue = cursor.fetchone()
+            
+            cursor.execute('''
+            SELECT b.*, COUNT(q.id) - COUNT(q.started_at) AS waiting, COUNT(q.started_at) AS running
+            FROM llm_quota_buckets b
+            LEFT JOIN llm_queue q ON q.quota_key = b.quota_key AND q.lease_expires >= ?
+            WHERE ? IS NULL OR b.quota_key = ?
+            GROUP BY b.quota_key
+            ORDER BY b.calls_total DESC
+            ''', (now, quota_key, quota_key))
+            
+            users = []
+            for row in cursor.fetchall():
+                tier = app.config['LLM_TIERS'].get(row['tier'], app.config['LLM_TIERS'][app.config['LLM_DEFAULT_TIER']])
+                tokens = refill_llm_tokens(row['tokens'], row['updated_at'], tier, now)
+                users.append({
+                    "client": row['quota_key'],
+                    "tier": row['tier'],
+                    "tokens_available": round(tokens, 2),
+                    "calls_total": row['calls_total'],
+                    "rejected_total": row['rejected_total'],
+                    "waiting": row['waiting'],
+                    "running": row['running'],
+                })
+        
+        return jsonify({
+            "success": True,
+            "queue": {
+                "waiting": queue['waiting'],
+                "running": queue['running'],
+                "capacity": app.config['LLM_MAX_CONCURRENT']
+            },
+            "users": users
+        })
+    
+    except Exception as e:
+        logger.error(f"Error in get_llm_usage: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 # @app.route('/api/upload-cv', methods=['POST'])
 # def upload_cv():
     """
@@ -377,31 +1858,53 @@ def health_check():
 
 @app.route('/api/upload-cv', methods=['POST'])
 def upload_cv():
+    """
+    Endpoint to upload and store a CV file.
+    Requires: file in request.files['cv']
+    Optional: user_id and previous_cv_id (one of the user's own CVs) in request.form;
+    without previous_cv_id the upload is linked to the user's latest CV with the same
+    file name. Uploads of anonymous users (user_id 0) are never linked.
+    """
     try:
         file = request.files['cv']
-        user_id = request.form.get('user_id', 0)
+        user_id = request.form.get('user_id', 0, type=int)
+        previous_cv_id = request.form.get('previous_cv_id', type=int)
         original_filename = secure_filename(file.filename)
         file_extension = original_filename.rsplit('.', 1)[1].lower()
         unique_filename = f"{uuid.uuid4()}.{file_extension}"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
-
-        logger.info("File saved")
+        with log_stage('save'):
+            file.save(file_path)
 
         try:
-            cv_text = extract_text_from_file(file_path)
-            logger.info("Text extracted")
+            with log_stage('extract'):
+                cv_text = extract_text_from_file(file_path)
+        except UnsupportedFileError as e:
+            os.remove(file_path)
+            return jsonify({"error": str(e)}), 415
         except Exception as e:
             logger.error(f"Text extraction error: {e}")
             return jsonify({"error": "Text extraction failed"}), 500
 
         try:
-            with sqlite3.connect(app.config['DATABASE']) as conn:
+            with log_stage('db'), sqlite3.connect(app.config['DATABASE']) as conn:
                 cursor = conn.cursor()
+                if previous_cv_id:
+                    cursor.execute('SELECT 1 FROM cvs WHERE id = ? AND user_id = ? AND user_id != 0',
+                                   (previous_cv_id, user_id))
+                    if not cursor.fetchone():
+                        os.remove(file_path)
+                        return jsonify({"error": "Previous CV not found"}), 404
+                elif user_id:
+                    cursor.execute('''
+                        SELECT id FROM cvs WHERE user_id = ? AND file_name = ? ORDER BY id DESC LIMIT 1
+                    ''', (user_id, original_filename))
+                    row = cursor.fetchone()
+                    previous_cv_id = row[0] if row else None
                 cursor.execute('''
-                    INSERT INTO cvs (user_id, file_name, file_path, content, created_at)
-                    VALUES (?, ?, ?, ?, datetime('now'))
-                ''', (user_id, original_filename, file_path, cv_text))
+                    INSERT INTO cvs (user_id, file_name, file_path, content, previous_cv_id, created_at)
+                    VALUES (?, ?, ?, ?, ?, datetime('now'))
+                ''', (user_id, original_filename, file_path, cv_text, previous_cv_id))
                 conn.commit()
                 cv_id = cursor.lastrowid
         except Exception as e:
@@ -411,7 +1914,7 @@ def upload_cv():
         try:
             preview = cv_text[:200] + "..." if len(cv_text) > 200 else cv_text
             preview = preview.encode("utf-8", "ignore").decode("utf-8")
-            logger.info(preview)
+            logger.debug(preview)
         except Exception as e:
             logger.warning(f"Preview error: {e}")
             preview = "[Preview not available]"
@@ -429,6 +1932,85 @@ def upload_cv():
         return jsonify({"error": "Unhandled server error"}), 500
 
 
+@app.route('/api/bulk-upload-cv', methods=['POST'])
+def bulk_upload_cv():
+    """
+    Endpoint to import every CV contained in a ZIP archive.
+    Requires: ZIP file in request.files['archive'], up to BULK_IMPORT_MAX_CONTENT_LENGTH bytes
+    Optional: user_id in request.form
+    The import runs as a background job, so large archives are not cut short by the
+    worker timeout; poll the returned status_url for progress and the final summary.
+    """
+    # Must be raised before the form is parsed; the upload is spooled to a temporary file
+    request.max_content_length = app.config['BULK_IMPORT_MAX_CONTENT_LENGTH']
+    if 'archive' not in request.files:
+        return jsonify({"error": "No archive part"}), 400
+
+    try:
+        user_id = request.form.get('user_id', 0)
+        fd, archive_path = tempfile.mkstemp(suffix='.zip')
+        with os.fdopen(fd, 'wb') as archive:
+            request.files['archive'].save(archive)
+        if not zipfile.is_zipfile(archive_path):
+            os.remove(archive_path)
+            return jsonify({"error": "Archive is not a valid ZIP file"}), 400
+
+        with sqlite3.connect(app.config['DATABASE']) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT INTO import_jobs (user_id, status, updated_at) VALUES (?, 'running', ?)
+            ''', (user_id, time.time()))
+            job_id = cursor.lastrowid
+
+        threading.Thread(target=run_import_job, args=(job_id, archive_path, user_id),
+                         name=f"import-job-{job_id}", daemon=True).start()
+
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "status": "running",
+            "status_url": f"/api/bulk-upload-cv/{job_id}"
+        }), 202
+
+    except Exception as e:
+        logger.error(f"Error in bulk_upload_cv: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/bulk-upload-cv/<int:job_id>', methods=['GET'])
+def get_bulk_upload_status(job_id):
+    """
+    Endpoint to report the progress of a bulk import job.
+    Requires: job_id as path parameter
+    Status is running, done, failed or interrupted; the summary holds the counts so far.
+    """
+    try:
+        with sqlite3.connect(app.config['DATABASE']) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,))
+            job = cursor.fetchone()
+
+        if not job:
+            return jsonify({"error": "Import job not found"}), 404
+
+        status = job['status']
+        if status == 'running' and job['updated_at'] < time.time() - app.config['BULK_IMPORT_STALE_AFTER']:
+            status = 'interrupted'
+
+        return jsonify({
+            "success": True,
+            "job_id": job['id'],
+            "user_id": job['user_id'],
+            "status": status,
+            "error": job['error'],
+            "created_at": job['created_at'],
+            **(json.loads(job['summary']) if job['summary'] else {"imported": 0, "failed": 0})
+        })
+
+    except Exception as e:
+        logger.error(f"Error in get_bulk_upload_status: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/job-description', methods=['POST'])
 def save_job_description():
     """
@@ -472,7 +2054,8 @@ def analyze_cv():
     """
     Endpoint to analyze a CV against a job description.
     Requires: cv_id and job_description_id in request JSON
-    Optional: user_id in request JSON
+    Optional: user_id in request JSON, Idempotency-Key header
+    Identical concurrent requests share a single analysis and result ID.
     """
     try:
         data = request.get_json()
@@ -481,7 +2064,8 @@ def analyze_cv():
         
         cv_id = data.get('cv_id')
         job_description_id = data.get('job_description_id')
-        user_id = data.get('user_id', 0)
+        # Logged-out clients send 0 (or null); both are stored as anonymous user 0
+        user_id = data.get('user_id') or 0
         
         if not cv_id or not job_description_id:
             return jsonify({"error": "CV ID and Job Description ID are required"}), 400
@@ -502,9 +2086,27 @@ def analyze_cv():
                 return jsonify({"error": "Job description not found"}), 404
             job_description = job_row['content']
         
-        analysis_result = analyze_cv_with_gemini(cv_text, job_description)
+        # Identical analyses always share one run; an Idempotency-Key additionally
+        # replays its result to retries long after the run has finished. The job description
+        # is identified by its text, since the frontend saves a new row for every submission.
+        job_description_hash = hashlib.sha256(job_description.encode('utf-8')).hexdigest()
+        fingerprint = f"{user_id}:{cv_id}:{job_description_hash}"
+        idempotency_key = request.headers.get('Idempotency-Key')
+        key = f"key:{user_id}:{idempotency_key}" if idempotency_key else None
+        result_id = find_idempotent_result(key, fingerprint) if key else None
         
-        result_id = save_analysis_result(user_id, cv_id, job_description_id, analysis_result)
+        if result_id is not None:
+            analysis_result = load_analysis_result(result_id)
+        else:
+            def analyze():
+                analysis_result = run_cv_analysis(cv_id, cv_text, job_description, user_id)
+                with log_stage('save'):
+                    return save_analysis_result(user_id, cv_id, job_description_id, analysis_result), analysis_result
+            
+            result_id, analysis_result = run_analysis_once(
+                f"auto:{fingerprint}", fingerprint, app.config['ANALYSIS_COALESCE_WINDOW'], analyze)
+            if key and result_id != -1 and analysis_result.get('status') != 'error':
+                remember_idempotent_result(key, fingerprint, result_id)
         
         return jsonify({
             "success": True,
@@ -512,6 +2114,14 @@ def analyze_cv():
             "analysis": analysis_result
         })
     
+    except IdempotencyConflictError as e:
+        return jsonify({"error": str(e)}), 422
+    except QuotaExceededError as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(int(e.retry_after) + 1)}
+    except QueueTimeoutError as e:
+        return jsonify({"error": str(e)}), 503
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         logger.error(f"Error in analyze_cv: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -598,6 +2208,10 @@ def get_analysis_result(result_id):
                 "cv_content": row['cv_content'],
                 "job_title": row['job_title'],
                 "job_description": row['job_description'],
+                "prompt_template": row['prompt_template'],
+                "prompt_version": row['prompt_version'],
+                "model": row['model'],
+                "base_result_id": row['base_result_id'],
                 "created_at": row['created_at']
             }
             
@@ -610,6 +2224,61 @@ def get_analysis_result(result_id):
         logger.error(f"Error in get_analysis_result: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    """
+    Endpoint to retrieve score statistics and daily trends from the analytics rollups.
+    Optional: user_id or job_description_id as query parameter (defaults to all results),
+    days as query parameter for the trend length (defaults to 30)
+    """
+    try:
+        user_id = request.args.get('user_id')
+        job_description_id = request.args.get('job_description_id')
+        days = min(max(request.args.get('days', 30, type=int), 1), 365)
+        
+        if user_id:
+            scope, scope_id, trend_scope = 'user', user_id, 'user_day'
+        elif job_description_id:
+            scope, scope_id, trend_scope = 'job', job_description_id, 'job_day'
+        else:
+            scope, scope_id, trend_scope = 'all', '', 'day'
+        
+        # Trend rows are keyed "<id>:<date>" ("<date>" for all results), so a day range is a key range
+        prefix = f"{scope_id}:" if scope_id else ""
+        today = datetime.utcnow().date()
+        first_day = (today - timedelta(days=days - 1)).isoformat()
+        
+        with sqlite3.connect(app.config['DATABASE']) as conn:
+            cursor = conn.cursor()
+            stats = read_rollup(cursor, scope, scope_id)
+            
+            cursor.execute('''
+            SELECT scope_id, count, score_sum
+            FROM analysis_rollups
+            WHERE scope = ? AND scope_id BETWEEN ? AND ? AND count > 0
+            ORDER BY scope_id
+            ''', (trend_scope, prefix + first_day, prefix + today.isoformat()))
+            
+            trend = []
+            for key, count, score_sum in cursor.fetchall():
+                trend.append({
+                    "date": key[len(prefix):],
+                    "count": count,
+                    "average": round(score_sum / count, 2)
+                })
+        
+        return jsonify({
+            "success": True,
+            "scope": scope,
+            "scope_id": scope_id or None,
+            "stats": stats,
+            "trend": trend
+        })
+    
+    except Exception as e:
+        logger.error(f"Error in get_analytics: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/register', methods=['POST'])
 def register_user():
     """
@@ -773,43 +2442,30 @@ def export_improved_cv(result_id):
     """
     Endpoint to export the improved CV as a downloadable file.
     Requires: result_id as path parameter
+    Optional: format query parameter (txt, docx or pdf; defaults to txt)
     """
     try:
         format_type = request.args.get('format', 'txt')
+        if format_type not in EXPORT_FORMATS:
+            return jsonify({"error": f"Export format '{format_type}' not supported. Supported formats: {', '.join(EXPORT_FORMATS)}"}), 400
         
         with sqlite3.connect(app.config['DATABASE']) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-            SELECT ar.improved_cv, c.file_name
-            FROM analysis_results ar
-            JOIN cvs c ON ar.cv_id = c.id
-            WHERE ar.id = ?
-            ''', (result_id,))
-            
-            row = cursor.fetchone()
-            if not row:
+            if not conn.execute('SELECT 1 FROM analysis_results WHERE id = ?', (result_id,)).fetchone():
                 return jsonify({"error": "Analysis result not found"}), 404
-            
-            improved_cv = row['improved_cv']
-            original_filename = row['file_name'].rsplit('.', 1)[0]  # Remove extension
-            
-            temp_dir = tempfile.gettempdir()
-            
-            if format_type == 'txt':
-                file_path = os.path.join(temp_dir, f"{original_filename}_improved.txt")
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(improved_cv)
-                
-                return send_from_directory(
-                    directory=temp_dir,
-                    path=f"{original_filename}_improved.txt",
-                    as_attachment=True,
-                    download_name=f"{original_filename}_improved.txt"
-                )
-            
-            return jsonify({"error": f"Export format '{format_type}' not supported yet"}), 400
+        
+        try:
+            content, download_name = render_export(result_id, format_type)
+        except LookupError as e:
+            return jsonify({"error": str(e)}), 404
+        
+        mimetype, _ = EXPORT_FORMATS[format_type]
+        return send_file(
+            io.BytesIO(content),
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            etag=f"{result_id}-{format_type}"
+        )
     
     except Exception as e:
         logger.error(f"Error in export_improved_cv: {str(e)}")
@@ -897,5 +2553,60 @@ def get_user_job_descriptions():
         logger.error(f"Error in get_user_job_descriptions: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.cli.command('import-cvs')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--user-id', default=0, help='User the imported CVs belong to.')
+def import_cvs_command(source, user_id):
+    """Bulk import CVs from a directory or ZIP archive."""
+    def report(summary):
+        click.echo(f"{summary['imported']} imported, {summary['failed']} failed")
+
+    if os.path.isdir(source):
+        summary = bulk_import_cvs(iter_directory_entries(source), user_id, report)
+    else:
+        with zipfile.ZipFile(source) as archive:
+            summary = bulk_import_cvs(iter_zip_entries(archive), user_id, report)
+
+    for failure in summary['failures']:
+        click.echo(f"FAILED {failure['file']}: {failure['error']}", err=True)
+    click.echo(f"Done: {summary['imported']} CVs in {summary['elapsed_seconds']}s "
+               f"({summary['cvs_per_minute']} CVs/minute)")
+
+@app.cli.command('rebuild-analytics')
+def rebuild_analytics_command():
+    """Recompute analytics rollups from analysis_results and the retention archive, and report any drift."""
+    def snapshot(cursor):
+        cursor.execute('SELECT scope, scope_id, count, score_sum, score_sq_sum FROM analysis_rollups WHERE count != 0')
+        rollups = {row[:2]: (row[2], round(row[3], 6), round(row[4], 6)) for row in cursor.fetchall()}
+        cursor.execute('SELECT scope, scope_id, bucket, count FROM analysis_rollup_buckets WHERE count != 0')
+        buckets = {row[:3]: row[3] for row in cursor.fetchall()}
+        return rollups, buckets
+
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        cursor = conn.cursor()
+        before_rollups, before_buckets = snapshot(cursor)
+        rebuild_analysis_rollups(cursor)
+        after_rollups, after_buckets = snapshot(cursor)
+        conn.commit()
+
+    drifted = [key for key in before_rollups.keys() | after_rollups.keys()
+               if before_rollups.get(key) != after_rollups.get(key)]
+    drifted_buckets = [key for key in before_buckets.keys() | after_buckets.keys()
+                       if before_buckets.get(key) != after_buckets.get(key)]
+    for scope, scope_id in sorted(drifted):
+        click.echo(f"DRIFT {scope} {scope_id}: {before_rollups.get((scope, scope_id))} -> "
+                   f"{after_rollups.get((scope, scope_id))}", err=True)
+    click.echo(f"Rebuilt {len(after_rollups)} rollups: {len(drifted)} rollups and "
+               f"{len(drifted_buckets)} histogram buckets differed from the maintained values")
+
+@app.cli.command('run-retention')
+@click.option('--full-vacuum', is_flag=True,
+              help='Run a blocking VACUUM, also switching an existing database to incremental auto-vacuum.')
+def run_retention_command(full_vacuum):
+    """Archive old analysis results, delete orphaned uploads and vacuum the database."""
+    report = run_retention(full_vacuum)
+    for key, value in report.items():
+        click.echo(f"{key}: {value}")
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""
+Check that importing the app stays fast and that the heavy dependencies,
+which app.py imports on first use, are not loaded at startup.
+
+Usage: python check_import_time.py [--max-ms 500]
+Exits with status 1 if the check fails.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+# Modules that must not be imported by `import app`
+LAZY_MODULES = ('pdfplumber', 'google.generativeai', 'openai')
+
+
+def measure_import() -> dict:
+    """Import the app in a fresh interpreter with -X importtime; return cumulative microseconds per module."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo, os.environ.get('PYTHONPATH')])))
+    # Run in a scratch directory, since importing the app creates its database, uploads folder and log
+    with tempfile.TemporaryDirectory() as workdir:
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                                   cwd=workdir, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.exit(f"Importing the app failed:\n{completed.stderr}")
+
+    timings = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        timings[module.strip()] = int(cumulative)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--max-ms', type=float, default=500, help='Maximum time to import the app, in milliseconds.')
+    args = parser.parse_args()
+
+    timings = measure_import()
+    import_ms = timings['app'] / 1000
+    loaded = sorted(module for module in timings
+                    if any(module == lazy or module.startswith(lazy + '.') for lazy in LAZY_MODULES))
+
+    print(f"import app: {import_ms:.1f} ms (limit {args.max_ms:.0f} ms)")
+    for module, cumulative in sorted(timings.items(), key=lambda item: -item[1])[1:11]:
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+    failed = False
+    if import_ms > args.max_ms:
+        print(f"FAILED: importing the app took longer than {args.max_ms:.0f} ms")
+        failed = True
+    if loaded:
+        print(f"FAILED: imported at startup instead of on first use: {', '.join(loaded)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
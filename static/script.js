@@ -224,6 +224,11 @@ document.getElementById('cv-upload-form').addEventListener('submit', async (e) =
 
 // Analyze Button
 document.getElementById('analyze-btn').addEventListener('click', async () => {
+    const analyzeBtn = document.getElementById('analyze-btn');
+    if (analyzeBtn.disabled) {
+        return;
+    }
+    
     const cvId = document.getElementById('cv-select').value;
     const jobDescription = document.getElementById('job-description').value;
     
@@ -237,6 +242,13 @@ document.getElementById('analyze-btn').addEventListener('click', async () => {
         return;
     }
     
+    // One key per analysis attempt; the request is resent with it after a network
+    // error, and the server then replays the first result instead of analysing again
+    const idempotencyKey = window.crypto && crypto.randomUUID
+        ? crypto.randomUUID()
+        : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+    analyzeBtn.disabled = true;
+    
     try {
         document.getElementById('analysis-loading').classList.remove('hidden');
         
@@ -259,10 +271,11 @@ document.getElementById('analyze-btn').addEventListener('click', async () => {
             const jobDescriptionId = jobData.job_description_id;
             
             // Now analyze the CV against the job description
-            const analyzeResponse = await fetch(`${API_URL}/analyze`, {
+            const sendAnalyzeRequest = () => fetch(`${API_URL}/analyze`, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': idempotencyKey
                 },
                 body: JSON.stringify({
                     cv_id: cvId,
@@ -271,6 +284,13 @@ document.getElementById('analyze-btn').addEventListener('click', async () => {
                 })
             });
             
+            let analyzeResponse;
+            try {
+                analyzeResponse = await sendAnalyzeRequest();
+            } catch (networkError) {
+                analyzeResponse = await sendAnalyzeRequest();
+            }
+            
             const analyzeData = await analyzeResponse.json();
             
             document.getElementById('analysis-loading').classList.add('hidden');
@@ -305,6 +325,8 @@ document.getElementById('analyze-btn').addEventListener('click', async () => {
         document.getElementById('analysis-loading').classList.add('hidden');
         console.error('Error analyzing CV:', error);
         alert('Analysis failed. Please try again later.');
+    } finally {
+        analyzeBtn.disabled = false;
     }
 });
 
@@ -316,7 +338,8 @@ document.getElementById('download-cv-btn').addEventListener('click', async () =>
     }
     
     try {
-        window.location.href = `${API_URL}/export-cv/${currentResultId}?format=txt`;
+        const format = document.getElementById('export-format').value;
+        window.location.href = `${API_URL}/export-cv/${currentResultId}?format=${format}`;
     } catch (error) {
         console.error('Error downloading CV:', error);
         alert('Download failed. Please try again later.');
@@ -0,0 +1,134 @@
+"""
+Text extraction from uploaded CV files (PDF, DOCX and legacy DOC).
+
+Kept free of import-time side effects, unlike app.py, so that bulk import
+worker processes can import it without touching the database or logging setup.
+"""
+import logging
+import re
+import shutil
+import subprocess
+import zipfile
+from xml.etree import ElementTree
+from typing import IO, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class UnsupportedFileError(ValueError):
+    """Raised when an uploaded file cannot be read as a CV."""
+
+def extract_text_from_pdf(file_path: str) -> str:
+    """Extract text from a PDF file."""
+    import pdfplumber  # imported on first use, it is slow to load
+
+    try:
+        text = ""
+        with pdfplumber.open(file_path) as pdf:
+            for page in pdf.pages:
+                text += page.extract_text() or ""
+        return text
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF: {str(e)}")
+        return ""
+
+# WordprocessingML parts that hold CV text, and the elements we read from them
+DOCX_TEXT_PARTS = re.compile(r'word/(header\d*|document|footer\d*)\.xml$')
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+OLE2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP_MAGIC = b'PK\x03\x04'
+
+def iter_docx_part_paragraphs(part: IO[bytes]) -> Iterator[str]:
+    """
+    Incrementally parse one WordprocessingML part and yield its paragraphs in
+    document order, including those inside tables and text boxes.
+    """
+    paragraphs = []
+    fallback_depth = 0
+    for event, elem in ElementTree.iterparse(part, events=('start', 'end')):
+        tag = elem.tag
+        if tag == MC_FALLBACK:
+            # Text boxes are stored twice (DrawingML and a VML fallback); read only the first
+            fallback_depth += 1 if event == 'start' else -1
+        elif fallback_depth:
+            continue
+        elif tag == W_NS + 'p':
+            if event == 'start':
+                paragraphs.append([])
+            else:
+                yield "".join(paragraphs.pop())
+                elem.clear()
+        elif event == 'start':
+            continue
+        elif tag == W_NS + 'tbl':
+            elem.clear()
+        elif paragraphs:
+            if tag == W_NS + 't':
+                paragraphs[-1].append(elem.text or "")
+            elif tag == W_NS + 'tab':
+                paragraphs[-1].append("\t")
+            elif tag in (W_NS + 'br', W_NS + 'cr'):
+                paragraphs[-1].append("\n")
+
+def extract_text_from_docx(file_path: str) -> str:
+    """
+    Extract text from a DOCX file by streaming its document, header and footer
+    parts, without building the full python-docx object tree.
+    """
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            names = [name for name in archive.namelist() if DOCX_TEXT_PARTS.match(name)]
+            # Headers first, then the body, then footers
+            names.sort(key=lambda name: ('header' not in name, 'footer' in name, name))
+            lines = []
+            for name in names:
+                with archive.open(name) as part:
+                    lines.extend(iter_docx_part_paragraphs(part))
+        return "\n".join(lines)
+    except Exception as e:
+        logger.error(f"Error extracting text from DOCX: {str(e)}")
+        return ""
+
+def extract_text_from_doc(file_path: str) -> str:
+    """
+    Extract text from a legacy Word 97-2003 (.doc) file using antiword when it
+    is installed; otherwise the file is rejected.
+    """
+    antiword = shutil.which('antiword')
+    if not antiword:
+        raise UnsupportedFileError("Legacy .doc files are not supported. Please upload a PDF or DOCX file.")
+    try:
+        completed = subprocess.run([antiword, file_path], capture_output=True, timeout=30, check=True)
+        return completed.stdout.decode('utf-8', 'ignore')
+    except (subprocess.SubprocessError, OSError) as e:
+        logger.error(f"Error extracting text from DOC: {str(e)}")
+        raise UnsupportedFileError("Could not read legacy .doc file. Please upload a PDF or DOCX file.")
+
+def extract_text_from_file(file_path: str) -> str:
+    """Extract text from different file types."""
+    file_extension = file_path.split('.')[-1].lower()
+    
+    if file_extension == 'pdf':
+        return extract_text_from_pdf(file_path)
+    elif file_extension in ['docx', 'doc']:
+        # Word files are told apart by content, since .doc/.docx names are often swapped
+        with open(file_path, 'rb') as f:
+            magic = f.read(8)
+        if magic.startswith(ZIP_MAGIC):
+            return extract_text_from_docx(file_path)
+        if magic == OLE2_MAGIC:
+            return extract_text_from_doc(file_path)
+        raise UnsupportedFileError("File is not a valid Word document")
+    else:
+        return ""
+
+def extract_import_text(file_path: str) -> Tuple[str, Optional[str]]:
+    """Extract text for a bulk import worker, returning (text, error) instead of raising."""
+    try:
+        text = extract_text_from_file(file_path)
+    except UnsupportedFileError as e:
+        return "", str(e)
+    # The PDF and DOCX extractors return an empty string for files they cannot read
+    if not text.strip():
+        return "", "No text could be extracted from the file"
+    return text, None